@@ -7,4 +7,5 @@ export NAME=rfcsearch
 python -W ignore -u tools/create_documents.py \
     --data $DIR/$FILE \
     --save $DIR/documents.json \
+    --embeddings $DIR/embeddings.npy \
     --index_name $NAME 
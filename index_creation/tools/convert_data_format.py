@@ -6,6 +6,8 @@ import pandas as pd
 from tqdm import tqdm
 
 
+INFO_COLUMNS = ['Status', 'Date', 'Obsoleted_by', 'Updated_by', 'Formats', 'DOI']
+
 
 def parse_arguments():
     """
@@ -17,18 +19,45 @@ def parse_arguments():
                         default='/raid/antoloui/Master-thesis/search/rfc/_data/processed/',
                         help="Path to the data directory.",
     )
+    parser.add_argument("--info_file",
+                        type=str,
+                        default=None,
+                        help="Path to the csv file with info about RFCs (default: '$data_dir/../info.csv').",
+    )
     arguments, _ = parser.parse_known_args()
     return arguments
 
 
+def load_rfc_info(filepath):
+    """
+    Load the metadata of each RFC (status, date, obsoleting and updating RFCs, formats, DOI),
+    indexed by RFC name.
+    """
+    # Load csv file about RFCs.
+    df = pd.read_csv(filepath, index_col=0, dtype=str)
+    df['Name'] = df['Name'].str.lower()
+    
+    # Convert dates of publication to ISO format (e.g. 'April 1969' -> '1969-04-01').
+    df['Date'] = pd.to_datetime(df['Date'], errors='coerce').dt.strftime('%Y-%m-%d')
+    
+    # Rename the misspelled column from the index.
+    df = df.rename(columns={'Obsoloted_by': 'Obsoleted_by'})
+    
+    return df.set_index('Name')[INFO_COLUMNS]
+
+
 def main(args):
     """
     """
     # Get paths of all files in repo.
     filepaths = [f for f in glob.glob(args.data_dir+"*.txt")]
     
+    # Load info about all RFCs.
+    info_file = args.info_file or args.data_dir + '../info.csv'
+    info = load_rfc_info(info_file) if os.path.isfile(info_file) else None
+    
     # Create global dataframe to store all.
-    global_df = pd.DataFrame(columns=['Title', 'Text'])
+    global_df = pd.DataFrame(columns=['Name', 'Title', 'Text'] + INFO_COLUMNS)
     
     for i, filename in enumerate(tqdm(filepaths)):
         # Read file.
@@ -43,14 +72,20 @@ def main(args):
             texts.append(line.split('*')[2].strip())
 
         # Create dataframe.
-        d = {'Title':titles,'Text':texts}
+        name = os.path.splitext(os.path.basename(filename))[0].lower()
+        d = {'Name':name,'Title':titles,'Text':texts}
         df = pd.DataFrame(d)
         
+        # Add the metadata of the RFC to each of its paragraphs.
+        if info is not None and name in info.index:
+            for column in INFO_COLUMNS:
+                df[column] = info.at[name, column]
+        
         # Concat to global one.
         global_df = pd.concat([global_df, df], axis=0)
         
-    # Convert all dataframe to strings.
-    global_df = global_df.astype(str)
+    # Convert all dataframe to strings (missing metadata is kept empty).
+    global_df = global_df.fillna('').astype(str)
         
     # Save global dataframe.
     global_df.to_csv(args.data_dir + '../data.csv', sep=',', encoding='utf-8', float_format='%.10f', decimal='.')
@@ -16,25 +16,47 @@
 """Convert Huggingface Pytorch checkpoint to Tensorflow checkpoint."""
 
 import os
+import pickle
+import zipfile
 import argparse
 import torch
 import numpy as np
 import tensorflow.compat.v1 as tf
-from transformers import BertModel
 
 ##-Added-------------------------------------------
-os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"
-os.environ["CUDA_VISIBLE_DEVICES"]="1" #"1,2,3,4,5,6,7" # specify which GPU(s) to be used
+os.environ["CUDA_VISIBLE_DEVICES"]="" # the conversion runs on CPU only
 ##-------------------------------------------------
 
 
-def convert_pytorch_checkpoint_to_tf(model:BertModel, ckpt_dir:str, model_name:str):
+def load_state_dict(path:str):
+    """
+    Load the weights of a Pytorch checkpoint lazily, without building the model.
+    :param path: /path/to/<pytorch-model-name>.bin or /path/to/<pytorch-model-name>.safetensors
+    :return: mapping from variable names to tensors, whose storage is memory-mapped when possible
+    """
+    if path.endswith(".safetensors"):
+        from safetensors import safe_open
+        with safe_open(path, framework="pt") as f:
+            return {name: f.get_tensor(name) for name in f.keys()}
+    # Memory-map the tensors storage (torch>=2.1), which requires the zipfile-based checkpoint format.
+    options = {"mmap": True} if zipfile.is_zipfile(path) else {}
+    try:
+        return torch.load(path, map_location="cpu", weights_only=True, **options)
+    except TypeError:
+        # Older torch versions, without mmap nor weights_only.
+        return torch.load(path, map_location="cpu")
+    except pickle.UnpicklingError:
+        # Checkpoint with non-tensor objects, refused by weights_only (the default since torch 2.6).
+        return torch.load(path, map_location="cpu", weights_only=False, **options)
+
+
+def convert_pytorch_checkpoint_to_tf(state_dict:dict, ckpt_dir:str, model_name:str):
 
     """
-    :param model:BertModel Pytorch model instance to be converted
+    :param state_dict: Pytorch weights of the model to be converted (see load_state_dict)
     :param ckpt_dir: Tensorflow model directory
     :param model_name: model name
-    :return:
+    :return: path of the saved Tensorflow checkpoint
     Currently supported HF models:
         Y BertModel
         N BertForMaskedLM
@@ -43,6 +65,7 @@ def convert_pytorch_checkpoint_to_tf(model:BertModel, ckpt_dir:str, model_name:s
         N BertForNextSentencePrediction
         N BertForSequenceClassification
         N BertForQuestionAnswering
+    For the unsupported models, only the weights of the underlying BertModel are converted.
     """
 
     tensors_to_transpose = (
@@ -63,38 +86,68 @@ def convert_pytorch_checkpoint_to_tf(model:BertModel, ckpt_dir:str, model_name:s
         ('weight', 'kernel')
     )
 
+    bert_modules = ("embeddings.", "encoder.", "pooler.")
+
     if not os.path.isdir(ckpt_dir):
         os.makedirs(ckpt_dir)
 
-    state_dict = model.state_dict()
+    def to_bert_var_name(name:str):
+        return name[len("bert."):] if name.startswith("bert.") else name
 
     def to_tf_var_name(name:str):
         for patt, repl in iter(var_map):
             name = name.replace(patt, repl)
         return 'bert/{}'.format(name)
 
-    def create_tf_var(tensor:np.ndarray, name:str, session:tf.Session):
-        tf_dtype = tf.dtypes.as_dtype(tensor.dtype)
-        tf_var = tf.get_variable(dtype=tf_dtype, shape=tensor.shape, name=name, initializer=tf.zeros_initializer())
-        session.run(tf.variables_initializer([tf_var]))
-        session.run(tf_var)
-        return tf_var
-
+    def to_numpy(name:str):
+        # Views on the (memory-mapped) storage: no copy is made until the tensor is fed to TF.
+        # Half-precision weights (fp16, bf16) are cast one at a time to the float32 of the BERT graph.
+        tensor = state_dict[name]
+        if tensor.dtype != torch.float32:
+            tensor = tensor.to(torch.float32)
+        tensor = tensor.numpy()
+        if any([x in name for x in tensors_to_transpose]):
+            tensor = tensor.T
+        return tensor
+
+    # Keep the weights of the BertModel only (skip task heads and non-trainable buffers such as position_ids).
+    var_names = [
+        name for name in state_dict
+        if to_bert_var_name(name).startswith(bert_modules) and state_dict[name].is_floating_point()
+    ]
+    skipped = [name for name in state_dict if name not in var_names]
+    if skipped:
+        print("Skipped {} tensors: {}".format(len(skipped), ", ".join(skipped)))
+
+    # Build all the variables, initialized from placeholders fed at once in a single assignment.
     tf.reset_default_graph()
-    with tf.Session() as session:
-        for var_name in state_dict:
-            tf_name = to_tf_var_name(var_name)
-            torch_tensor = state_dict[var_name].numpy()
-            if any([x in var_name for x in tensors_to_transpose]):
-                torch_tensor = torch_tensor.T
-            tf_var = create_tf_var(tensor=torch_tensor, name=tf_name, session=session)
-            tf.keras.backend.set_value(tf_var, torch_tensor)
-            tf_weight = session.run(tf_var)
-            print("Successfully created {}: {}".format(tf_name, np.allclose(tf_weight, torch_tensor)))
-
-        name = os.path.basename(model_name)
-        saver = tf.train.Saver(tf.trainable_variables())
-        saver.save(session, os.path.join(ckpt_dir, name.replace("-", "_") + ".ckpt"))
+    tf_vars = []
+    feed_dict = {}
+    for var_name in var_names:
+        tf_name = to_tf_var_name(to_bert_var_name(var_name))
+        torch_tensor = to_numpy(var_name)
+        placeholder = tf.placeholder(dtype=tf.dtypes.as_dtype(torch_tensor.dtype), shape=torch_tensor.shape)
+        tf_vars.append(tf.get_variable(name=tf_name, initializer=placeholder))
+        feed_dict[placeholder] = torch_tensor
+    saver = tf.train.Saver(tf_vars)
+
+    name = os.path.basename(os.path.normpath(model_name))
+    config = tf.ConfigProto(device_count={"GPU": 0})
+    with tf.Session(config=config) as session:
+        session.run(tf.variables_initializer(tf_vars), feed_dict=feed_dict)
+        del feed_dict
+        ckpt_path = saver.save(session, os.path.join(ckpt_dir, name.replace("-", "_") + ".ckpt"))
+
+    # Check the saved checkpoint in a single pass, one tensor at a time.
+    reader = tf.train.load_checkpoint(ckpt_path)
+    mismatches = [
+        var_name for var_name in var_names
+        if not np.allclose(reader.get_tensor(to_tf_var_name(to_bert_var_name(var_name))), to_numpy(var_name))
+    ]
+    if mismatches:
+        raise ValueError("Tensors not converted correctly: {}".format(", ".join(mismatches)))
+    print("Successfully converted {} tensors to {}".format(len(var_names), ckpt_path))
+    return ckpt_path
 
 
 def main(raw_args=None):
@@ -107,25 +160,19 @@ def main(raw_args=None):
                         type=str,
                         default=None,
                         required=False,
-                        help="Directory containing pytorch model")
+                        help="Unused, kept for compatibility: the model is no longer built to be converted")
     parser.add_argument("--pytorch_model_path",
                         type=str,
                         required=True,
-                        help="/path/to/<pytorch-model-name>.bin")
+                        help="/path/to/<pytorch-model-name>.bin or /path/to/<pytorch-model-name>.safetensors")
     parser.add_argument("--tf_cache_dir",
                         type=str,
                         required=True,
                         help="Directory in which to save tensorflow model")
     args = parser.parse_args(raw_args)
     
-    model = BertModel.from_pretrained(
-        pretrained_model_name_or_path=args.model_name,
-        state_dict=torch.load(args.pytorch_model_path),
-        cache_dir=args.cache_dir
-    )
-    
     convert_pytorch_checkpoint_to_tf(
-        model=model,
+        state_dict=load_state_dict(args.pytorch_model_path),
         ckpt_dir=args.tf_cache_dir,
         model_name=args.model_name
     )
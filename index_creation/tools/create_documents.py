@@ -1,35 +1,64 @@
 """
 Example script to create elasticsearch documents.
 """
+import os
 import json
 import time
 import argparse
 
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
 
 from bert_serving.client import BertClient
 bc = BertClient(output_fmt='list', check_version=False)
 
 
-def create_document(doc, emb, index_name):
+def create_document(doc, emb, index_name, doc_id):
     return {
         '_op_type': 'index',
         '_index': index_name,
+        '_id': str(doc_id),
         'text': doc['text'],
         'title': doc['title'],
+        'rfc_id': doc['rfc_id'],
+        'status': doc['status'],
+        'date': doc['date'],
+        'obsoleted_by': doc['obsoleted_by'],
+        'updated_by': doc['updated_by'],
+        'formats': doc['formats'],
+        'doi': doc['doi'],
         'text_vector': emb
     }
 
 
+def get_value(series, column):
+    """Get a metadata value from a row, or None if missing."""
+    value = series.get(column)
+    return None if pd.isna(value) or value == '' else value
+
+
+def split_values(value):
+    """Split a comma-separated metadata value (e.g. 'RFC0010, RFC0024') into a list."""
+    return [v.strip().lower() for v in value.split(',') if v.strip()] if value else []
+
+
 def load_dataset(path):
     docs = []
     df = pd.read_csv(path, dtype=str)
     for row in tqdm(df.iterrows(), total=df.shape[0]):
         series = row[1]
+        status = get_value(series, 'Status')
         doc = {
             'title': series.Title,
-            'text': series.Text
+            'text': series.Text,
+            'rfc_id': get_value(series, 'Name') or series.Title.split(' - ', 1)[0].strip().lower(),
+            'status': status.upper() if status else None,
+            'date': get_value(series, 'Date'),
+            'obsoleted_by': split_values(get_value(series, 'Obsoleted_by')),
+            'updated_by': split_values(get_value(series, 'Updated_by')),
+            'formats': [f.upper() for f in split_values(get_value(series, 'Formats'))],
+            'doi': get_value(series, 'DOI')
         }
         docs.append(doc)
     return docs
@@ -44,14 +73,34 @@ def bulk_predict(docs, batch_size=256):
             yield emb
 
 
+def create_embeddings_file(path, num_docs, dims):
+    """
+    Create the memory-mapped matrix of the normalized embeddings, whose row i is the embedding
+    of the document with id i. It is used by the exact search engine of the web app.
+    The matrix is written to a temporary file, moved to 'path' once complete (see main), so that
+    the web app never maps a partly written matrix.
+    """
+    return np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float32, shape=(num_docs, dims))
+
+
 def main(args):
     print("Loading dataset...")
     docs = load_dataset(args.data)
+    embeddings = None
     with open(args.save, 'w+') as f:
         print("Encoding dataset...")
-        for doc, emb in tqdm(zip(docs, bulk_predict(docs)), total=len(docs)):
-            d = create_document(doc, emb, args.index_name)
+        for i, (doc, emb) in enumerate(tqdm(zip(docs, bulk_predict(docs)), total=len(docs))):
+            d = create_document(doc, emb, args.index_name, i)
             f.write(json.dumps(d) + '\n')
+            if args.embeddings:
+                if embeddings is None:
+                    embeddings = create_embeddings_file(args.embeddings, len(docs), len(emb))
+                emb = np.asarray(emb, dtype=np.float32)
+                embeddings[i] = emb / max(np.linalg.norm(emb), 1e-12)
+    if embeddings is not None:
+        embeddings.flush()
+        del embeddings
+        os.replace(args.embeddings + '.tmp', args.embeddings)
 
 
 if __name__ == '__main__':
@@ -59,5 +108,6 @@ if __name__ == '__main__':
     parser.add_argument('--data', help='data for creating documents.')
     parser.add_argument('--save', help='created documents.')
     parser.add_argument('--index_name', default='rfcsearch', help='Elasticsearch index name.')
+    parser.add_argument('--embeddings', default=None, help='matrix of normalized embeddings for the exact search engine (.npy).')
     args = parser.parse_args()
     main(args)
@@ -1,33 +1,137 @@
 import os
+import json
 from pprint import pprint
 
-from flask import Flask, render_template, jsonify, request
-from elasticsearch import Elasticsearch
+from flask import Flask, Response, render_template, jsonify, request, stream_with_context
+from werkzeug.datastructures import MultiDict
+from elasticsearch import Elasticsearch, TransportError
 from bert_serving.client import BertClient
 
+from exact_search import EngineLoader
+from flow_control import AdmissionGate, Overloaded, SingleFlight
+from warmup import QueryLog, ResultStore, Warmer
+
 
 SEARCH_SIZE = 10
+PARAGRAPHS_PER_RFC = 3
+MAX_PARAGRAPHS_PER_RFC = 10
+MAX_SEARCH_SIZE = 100
+MAX_BATCH_QUERIES = 10000
+BATCH_CHUNK_SIZE = 100  # searches of a batch per matrix product or Elasticsearch _msearch request.
 INDEX_NAME = "rfcsearch" #INDEX_NAME = os.environ['INDEX_NAME']
+EMBEDDINGS_PATH = os.environ.get('EMBEDDINGS_PATH', '/data/embeddings.npy')
+
+MAX_ACTIVE_SEARCHES = 2  # searches running at once (the encoder has a single worker).
+MAX_QUEUED_SEARCHES = 16  # searches waiting for a slot before new ones get shed.
+QUEUE_TIMEOUT = 5  # seconds a search may wait for a slot.
+RETRY_AFTER = 2  # seconds, sent to the shed clients.
+
+QUERY_LOG_PATH = os.environ.get('QUERY_LOG_PATH', '/data/queries.json')
+LANDING_QUERY = "Search"  # search run by the web page when it is loaded.
+WARMUP_TOP_N = 100  # most frequent searches of the log whose results are precomputed.
+WARMUP_REFRESH_INTERVAL = 3600  # seconds between refreshes of the precomputed results.
+WARMUP_CHECK_INTERVAL = 60  # seconds between checks of the index version.
 
 
 app = Flask(__name__)
+searches = SingleFlight()
+gate = AdmissionGate(MAX_ACTIVE_SEARCHES, MAX_QUEUED_SEARCHES, QUEUE_TIMEOUT, RETRY_AFTER)
+engines = EngineLoader(EMBEDDINGS_PATH)
+query_log = QueryLog(QUERY_LOG_PATH)
+store = ResultStore()
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
 
-@app.route('/search')
-def analyzer():
-    bc = BertClient(ip='bertserving', output_fmt='list')
-    client = Elasticsearch('elasticsearch:9200')
+def build_filter_query(args):
+    """
+    Build the query selecting the candidate paragraphs from the RFC metadata filters:
+    - status: RFC status(es), repeated or comma-separated (e.g. 'PROPOSED STANDARD,INTERNET STANDARD');
+    - year_from, year_to: range of publication years (inclusive);
+    - exclude_obsoleted: if true, skip the RFCs that have been obsoleted by another one.
+    """
+    filters = []
+    must_not = []
 
-    query = request.args.get('q')
-    query_vector = bc.encode([query])[0]
+    statuses = [s.strip().upper() for value in args.getlist('status') for s in value.split(',') if s.strip()]
+    if statuses:
+        filters.append({"terms": {"status": statuses}})
+
+    year_from = args.get('year_from', type=int)
+    year_to = args.get('year_to', type=int)
+    if year_from is not None or year_to is not None:
+        date_range = {"format": "yyyy"}
+        if year_from is not None:
+            date_range["gte"] = "{}||/y".format(year_from)
+        if year_to is not None:
+            date_range["lte"] = "{}||/y".format(year_to)
+        filters.append({"range": {"date": date_range}})
+
+    if args.get('exclude_obsoleted', '').lower() in ('1', 'true', 'yes'):
+        must_not.append({"exists": {"field": "obsoleted_by"}})
+
+    if not filters and not must_not:
+        return {"match_all": {}}
+    return {"bool": {"filter": filters, "must_not": must_not}}
+
+
+def build_collapse(args):
+    """
+    Build the collapsing of the results on the RFC ids when the document-level search is asked
+    for ('group=rfc'). Each RFC is then scored by its best paragraph, and its top paragraphs
+    ('per_rfc', default 3) are returned as inner hits, so that the top distinct RFCs come back
+    in a single query.
+    """
+    if args.get('group') != 'rfc':
+        return None
+    per_rfc = min(max(args.get('per_rfc', PARAGRAPHS_PER_RFC, type=int), 1), MAX_PARAGRAPHS_PER_RFC)
+    return {
+        "field": "rfc_id",
+        "inner_hits": {
+            "name": "paragraphs",
+            "size": per_rfc,
+            "_source": {"includes": ["title", "text"]}
+        },
+        "max_concurrent_group_searches": 4
+    }
+
+
+def search_locally(engine, client, query_vectors, sizes):
+    """
+    Get the top paragraphs of each query from the exact search engine, then their text from
+    Elasticsearch, in the format of Elasticsearch responses.
+    """
+    ids, scores = engine.search(query_vectors, max(sizes))
+    docs = client.mget(
+        index=INDEX_NAME,
+        body={"ids": sorted({str(i) for i in ids.flat})},
+        _source_includes=["title", "text", "rfc_id", "status", "date"]
+    )["docs"]
+    sources = {doc["_id"]: doc["_source"] for doc in docs if doc.get("found")}
 
+    responses = []
+    for query_ids, query_scores, size in zip(ids, scores, sizes):
+        hits = [
+            {"_index": INDEX_NAME, "_id": str(i), "_score": float(score), "_source": sources[str(i)]}
+            for i, score in zip(query_ids[:size], query_scores[:size]) if str(i) in sources
+        ]
+        responses.append({
+            "hits": {
+                "total": {"value": len(engine), "relation": "eq"},
+                "max_score": hits[0]["_score"] if hits else None,
+                "hits": hits
+            }
+        })
+    return responses
+
+
+def build_search_body(query_vector, filter_query, collapse, size=SEARCH_SIZE):
+    # The filters restrict the candidate set, so that the script is only run on matching paragraphs.
     script_query = {
         "script_score": {
-            "query": {"match_all": {}},
+            "query": filter_query,
             "script": {
                 "source": "cosineSimilarity(params.query_vector, doc['text_vector']) + 1.0",
                 "params": {"query_vector": query_vector}
@@ -35,18 +139,203 @@ def analyzer():
         }
     }
 
-    response = client.search(
-        index=INDEX_NAME,
-        body={
-            "size": SEARCH_SIZE,
-            "query": script_query,
-            "_source": {"includes": ["title", "text"]}
-        }
-    )
+    body = {
+        "size": size,
+        "query": script_query,
+        "_source": {"includes": ["title", "text", "rfc_id", "status", "date"]}
+    }
+    if collapse is not None:
+        body["collapse"] = collapse
+    return body
+
+
+def search(args):
+    bc = BertClient(ip='bertserving', output_fmt='list')
+    client = Elasticsearch('elasticsearch:9200')
+
+    query = args.get('q')
+    query_vector = bc.encode([query])[0]
+
+    engine = engines.get()
+    filter_query = build_filter_query(args)
+    collapse = build_collapse(args)
+    if engine is not None and filter_query == {"match_all": {}} and collapse is None:
+        # The exact search engine only serves the unfiltered paragraph-level searches.
+        response = search_locally(engine, client, [query_vector], [SEARCH_SIZE])[0]
+    else:
+        response = client.search(index=INDEX_NAME, body=build_search_body(query_vector, filter_query, collapse))
     print(query)
     pprint(response)
+    return response
+
+
+def search_key(args):
+    """Key identifying a search by all its parameters, regardless of their order."""
+    return tuple(sorted((name, tuple(values)) for name, values in args.lists()))
+
+
+def index_version():
+    """
+    Version of the index, which changes when it is recreated, when documents are added, or when
+    the embeddings file is replaced. The exact search engine is reloaded first, so that the
+    searches warmed for a new version run on the new embeddings.
+    """
+    client = Elasticsearch('elasticsearch:9200')
+    settings = client.indices.get_settings(index=INDEX_NAME)[INDEX_NAME]["settings"]["index"]
+    version = "{}:{}".format(settings["uuid"], client.count(index=INDEX_NAME)["count"])
+    engines.get()
+    if engines.version is not None:
+        version += ":{}:{}".format(*engines.version)
+    return version
+
+
+def warm_search(key):
+    args = MultiDict([(name, value) for name, values in key for value in values])
+    return gate.run(lambda: search(args))
+
+
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    response = jsonify({"error": str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+@app.route('/search')
+def analyzer():
+    args = request.args.copy()
+    key = search_key(args)
+    if args.get('q'):
+        query_log.record(key)
+
+    # The frequent searches are served from the precomputed results. The other identical
+    # concurrent searches share a single computation, which must first be admitted.
+    response = store.get(key)
+    if response is None:
+        response = searches.do(key, lambda: gate.run(lambda: search(args)))
     return jsonify(response)
 
 
+@app.route('/stats')
+def stats():
+    return jsonify(store.stats())
+
+
+def to_args(query):
+    """
+    Convert a query of a batch, either a string or an object with the parameters of /search
+    (e.g. {"q": "...", "size": 20, "status": ["HISTORIC"], "exclude_obsoleted": true}), to request args.
+    """
+    if not isinstance(query, dict):
+        query = {"q": query}
+    return MultiDict([
+        (name, str(value).lower() if isinstance(value, bool) else str(value))
+        for name, values in query.items()
+        for value in (values if isinstance(values, list) else [values])
+    ])
+
+
+def is_valid_query(query):
+    """Check that a query of a batch has a non-empty text to encode."""
+    text = query.get('q') if isinstance(query, dict) else query
+    return isinstance(text, str) and bool(text.strip())
+
+
+def batch_result(index, args, response):
+    """Line of the batch results, with either the response of the search or its error."""
+    if "error" in response:
+        return dict(response, index=index, q=args.get('q'))
+    return {"index": index, "q": args.get('q'), "response": response}
+
+
+def chunk_error(error):
+    """Error of the searches of a chunk that could not be run."""
+    if isinstance(error, Overloaded):
+        return {"error": str(error), "retry_after": error.retry_after}
+    return {"error": str(error)}
+
+
+def search_batch(queries):
+    """
+    Run a batch of searches, yielding each result as soon as the local matrix product or the
+    Elasticsearch _msearch request of its chunk is done. All the queries are encoded at once.
+    Once encoded, the searches of a chunk shed by the admission gate or failed by Elasticsearch
+    are yielded as errors, so that the other chunks still come back.
+    """
+    bc = BertClient(ip='bertserving', output_fmt='list')
+    client = Elasticsearch('elasticsearch:9200')
+
+    batch = [to_args(query) for query in queries]
+    query_vectors = gate.run(lambda: bc.encode([args.get('q', '') for args in batch]))
+
+    engine = engines.get()
+    local, remote = [], []
+    for i, args in enumerate(batch):
+        size = min(max(args.get('size', SEARCH_SIZE, type=int), 1), MAX_SEARCH_SIZE)
+        filter_query = build_filter_query(args)
+        collapse = build_collapse(args)
+        if engine is not None and filter_query == {"match_all": {}} and collapse is None:
+            local.append((i, size))
+        else:
+            remote.append((i, build_search_body(query_vectors[i], filter_query, collapse, size)))
+
+    for start in range(0, len(local), BATCH_CHUNK_SIZE):
+        chunk = local[start:start + BATCH_CHUNK_SIZE]
+        try:
+            responses = gate.run(lambda: search_locally(engine, client, [query_vectors[i] for i, _ in chunk], [size for _, size in chunk]))
+        except (Overloaded, TransportError) as error:
+            responses = [chunk_error(error)] * len(chunk)
+        for (i, _), response in zip(chunk, responses):
+            yield batch_result(i, batch[i], response)
+
+    for start in range(0, len(remote), BATCH_CHUNK_SIZE):
+        chunk = remote[start:start + BATCH_CHUNK_SIZE]
+        body = [line for _, search_body in chunk for line in ({}, search_body)]
+        try:
+            responses = gate.run(lambda: client.msearch(index=INDEX_NAME, body=body))["responses"]
+        except (Overloaded, TransportError) as error:
+            responses = [chunk_error(error)] * len(chunk)
+        for (i, _), response in zip(chunk, responses):
+            yield batch_result(i, batch[i], response)
+
+
+@app.route('/search/batch', methods=['POST'])
+def batch_analyzer():
+    # The batch is either a JSON list of queries or an object with a 'queries' list.
+    data = request.get_json(force=True, silent=True)
+    queries = data.get('queries') if isinstance(data, dict) else data
+    if not isinstance(queries, list) or not queries:
+        return jsonify({"error": "Expected a non-empty list of queries."}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({"error": "At most {} queries per batch.".format(MAX_BATCH_QUERIES)}), 413
+
+    # The encoder refuses empty strings, which would fail the whole batch.
+    invalid = [i for i, query in enumerate(queries) if not is_valid_query(query)]
+    if invalid:
+        return jsonify({"error": "Queries without a non-empty 'q' string at indexes {}.".format(invalid), "indexes": invalid}), 400
+
+    # Encode before streaming, so that an overloaded encoder is still answered with a 503.
+    results = search_batch(queries)
+    first = next(results)
+
+    def generate():
+        yield json.dumps(first) + '\n'
+        for result in results:
+            yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    Warmer(
+        store=store,
+        query_log=query_log,
+        search=warm_search,
+        index_version=index_version,
+        landing_keys=[search_key(MultiDict({'q': LANDING_QUERY}))],
+        top_n=WARMUP_TOP_N,
+        refresh_interval=WARMUP_REFRESH_INTERVAL,
+        check_interval=WARMUP_CHECK_INTERVAL
+    ).start()
+    app.run(host='0.0.0.0', port=5000, threaded=True)
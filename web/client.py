@@ -0,0 +1,47 @@
+"""
+Client of the batch search API of the web app, for running many queries against the RFC index.
+
+Example:
+    from client import batch_search
+
+    for result in batch_search(["congestion control", {"q": "ipv6 addressing", "size": 20, "exclude_obsoleted": True}]):
+        print(result["index"], result["q"], result.get("response", result.get("error")))
+"""
+import json
+import time
+import urllib.error
+import urllib.request
+
+
+def batch_search(queries, url='http://127.0.0.1:5000', batch_size=1000, max_retries=3):
+    """
+    Run the queries through the '/search/batch' endpoint, by batches of 'batch_size' queries.
+    :param queries: strings or objects with the parameters of '/search' (q, size, status, year_from,
+        year_to, exclude_obsoleted, group, per_rfc)
+    :param url: base URL of the web app
+    :param batch_size: number of queries sent per request
+    :param max_retries: number of retries of a batch refused with a 503 by an overloaded server
+    :return: iterator over the results, as they are streamed back, with 'index' the position of the
+        query in 'queries' and either the search 'response' or its 'error'
+    """
+    queries = list(queries)
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        request = urllib.request.Request(
+            url.rstrip('/') + '/search/batch',
+            data=json.dumps({"queries": batch}).encode('utf-8'),
+            headers={"Content-Type": "application/json"}
+        )
+        for attempt in range(max_retries + 1):
+            try:
+                with urllib.request.urlopen(request) as response:
+                    for line in response:
+                        if line.strip():
+                            result = json.loads(line)
+                            result["index"] += start
+                            yield result
+                break
+            except urllib.error.HTTPError as e:
+                if e.code != 503 or attempt == max_retries:
+                    raise
+                time.sleep(float(e.headers.get('Retry-After', 1)))
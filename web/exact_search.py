@@ -0,0 +1,122 @@
+"""
+Exact nearest neighbors search over the memory-mapped matrix of normalized embeddings
+created along with the Elasticsearch documents (see index_creation/tools/create_documents.py).
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+MIN_SHARD_SIZE = 50000  # rows, below which a scan is not worth splitting across cores.
+QUERY_BLOCK_SIZE = 256  # queries scored at once.
+
+
+class ExactSearchEngine:
+    """
+    Score all the documents by cosine similarity with a matrix product, and select the top-k
+    with argpartition. Row i of the matrix is the document with id i in Elasticsearch.
+    The scores are shifted by 1.0, as in the 'script_score' query of the web app.
+    """
+
+    def __init__(self, path, num_shards=None):
+        self.path = path
+        self.embeddings = np.load(path, mmap_mode='r')
+        num_shards = num_shards or os.cpu_count() or 1
+        num_shards = max(1, min(num_shards, len(self.embeddings) // MIN_SHARD_SIZE))
+        bounds = np.linspace(0, len(self.embeddings), num_shards + 1, dtype=int)
+        self.shards = list(zip(bounds[:-1], bounds[1:]))
+        self.executor = ThreadPoolExecutor(max_workers=num_shards) if num_shards > 1 else None
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def close(self):
+        """Stop the threads scanning the shards, once the running searches are done."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def search(self, query_vectors, k):
+        """
+        Get the k best documents of each query.
+        :param query_vectors: matrix of the query embeddings (one row per query)
+        :param k: number of documents to return per query
+        :return: (ids, scores), two matrices with one row per query, sorted by decreasing score
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        k = min(k, len(self.embeddings))
+        if k == 0 or len(queries) == 0:
+            return np.empty((len(queries), 0), dtype=int), np.empty((len(queries), 0), dtype=np.float32)
+
+        # The queries are scored by blocks, which bounds the size of the matrix of scores.
+        results = [self._search_block(queries[i:i + QUERY_BLOCK_SIZE], k) for i in range(0, len(queries), QUERY_BLOCK_SIZE)]
+        ids = np.concatenate([block_ids for block_ids, _ in results], axis=0)
+        scores = np.concatenate([block_scores for _, block_scores in results], axis=0)
+        return ids, scores
+
+    def _search_block(self, queries, k):
+        if self.executor is None:
+            ids, scores = self._search_shard(queries, k, *self.shards[0])
+        else:
+            # BLAS releases the GIL, so that the shards are scanned in parallel.
+            search_shard = lambda shard: self._search_shard(queries, k, *shard)
+            try:
+                results = self.executor.map(search_shard, self.shards)
+            except RuntimeError:
+                # The engine has been replaced (see EngineLoader) and its executor shut down.
+                results = map(search_shard, self.shards)
+            results = list(results)
+            ids = np.concatenate([shard_ids for shard_ids, _ in results], axis=1)
+            scores = np.concatenate([shard_scores for _, shard_scores in results], axis=1)
+            ids, scores = self._top_k(ids, scores, k)
+
+        order = np.argsort(-scores, axis=1)
+        return np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1) + 1.0
+
+    def _search_shard(self, queries, k, start, end):
+        scores = queries @ self.embeddings[start:end].T
+        ids = np.broadcast_to(np.arange(start, end), scores.shape)
+        return self._top_k(ids, scores, min(k, end - start))
+
+    @staticmethod
+    def _top_k(ids, scores, k):
+        if k < scores.shape[1]:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            ids, scores = np.take_along_axis(ids, top, axis=1), np.take_along_axis(scores, top, axis=1)
+        return ids, scores
+
+
+class EngineLoader:
+    """
+    Give the exact search engine over the current embeddings file, reloaded when the file is
+    replaced (new inode or mtime), e.g. after the index is rebuilt. The searches running on the
+    previous engine keep their mapping of the previous file, which stays valid once replaced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.engine = None
+        self.version = None
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def get(self):
+        """:return: the engine over the current file, or None if there is no file."""
+        version = self._stat()
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    previous = self.engine
+                    self.engine = ExactSearchEngine(self.path) if version is not None else None
+                    self.version = version
+                    if previous is not None:
+                        previous.close()
+        return self.engine
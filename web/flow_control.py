@@ -0,0 +1,88 @@
+"""
+Flow control of the search requests in front of the encoder and Elasticsearch.
+"""
+import threading
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted, so that it can be answered with a 503."""
+
+    def __init__(self, retry_after):
+        super().__init__("Too many search requests, retry in {} seconds.".format(retry_after))
+        self.retry_after = retry_after
+
+
+class _Call:
+    """An in-flight computation, shared by all the callers of the same key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical computations: the first caller of a key runs the computation,
+    and the callers arriving while it is in flight wait for it and share its result (or error).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AdmissionGate:
+    """
+    Bound the number of computations running at once ('max_active') and waiting for a slot
+    ('max_queued'). A request arriving while the queue is full, or waiting longer than
+    'queue_timeout' seconds, is shed right away with an Overloaded error.
+    """
+
+    def __init__(self, max_active, max_queued, queue_timeout, retry_after):
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._max_pending = max_active + max_queued
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_active)
+
+    def run(self, fn):
+        with self._lock:
+            if self._pending >= self._max_pending:
+                raise Overloaded(self.retry_after)
+            self._pending += 1
+        try:
+            if not self._slots.acquire(timeout=self.queue_timeout):
+                raise Overloaded(self.retry_after)
+            try:
+                return fn()
+            finally:
+                self._slots.release()
+        finally:
+            with self._lock:
+                self._pending -= 1
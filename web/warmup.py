@@ -0,0 +1,172 @@
+"""
+Precomputed results of the most frequent searches: the landing search of the web page and the
+most popular searches of the query log, refreshed on a schedule or when the index changes.
+"""
+import os
+import json
+import time
+import threading
+from collections import Counter
+
+
+class QueryLog:
+    """
+    Count the searches by key (see app.search_key) in memory. The counts of the 'max_entries'
+    most frequent searches are saved to a file if any, from the warmer rather than on each
+    search, so that they survive restarts.
+    """
+
+    def __init__(self, path=None, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                self._counts.update({self._to_key(key): count for key, count in json.load(f)})
+
+    @staticmethod
+    def _to_key(entry):
+        return tuple((name, tuple(values)) for name, values in entry)
+
+    def record(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def most_common(self, n):
+        with self._lock:
+            return [key for key, _ in self._counts.most_common(n)]
+
+    def save(self):
+        """Trim the counts to the most frequent searches, and save them atomically."""
+        with self._lock:
+            self._counts = Counter(dict(self._counts.most_common(self.max_entries)))
+            snapshot = list(self._counts.items())
+        if self.path and os.path.isdir(os.path.dirname(self.path) or '.'):
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(self.path + '.tmp', self.path)
+
+
+class ResultStore:
+    """
+    Results of the warmed searches by key, with the count of hits and misses. The version is the
+    one of the index for which the landing searches have been warmed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results = {}
+        self.version = None
+        self.warmed_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._results[key] = result
+
+    def retain(self, keys):
+        with self._lock:
+            self._results = {key: result for key, result in self._results.items() if key in keys}
+
+    def mark_warmed(self, version):
+        with self._lock:
+            self.version = version
+            self.warmed_at = time.time()
+
+    def clear(self):
+        with self._lock:
+            self._results = {}
+            self.version = None
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else None,
+                "entries": len(self._results),
+                "index_version": self.version,
+                "warmed_at": self.warmed_at
+            }
+
+
+class Warmer(threading.Thread):
+    """
+    Background job precomputing the results of the landing searches and of the 'top_n' most
+    frequent searches of the log. It runs on startup, then every 'refresh_interval' seconds, or as
+    soon as the index version (checked every 'check_interval' seconds) changes, e.g. after a rebuild.
+    The searches that fail (e.g. while the encoder is still loading its model, or when they are
+    shed under load) are retried, and the query log is saved, every 'check_interval' seconds.
+    """
+
+    def __init__(self, store, query_log, search, index_version, landing_keys, top_n, refresh_interval, check_interval):
+        super().__init__(daemon=True)
+        self.store = store
+        self.query_log = query_log
+        self.search = search
+        self.index_version = index_version
+        self.landing_keys = landing_keys
+        self.top_n = top_n
+        self.refresh_interval = refresh_interval
+        self.check_interval = check_interval
+        self.version = None
+        self.refreshed_at = None
+        self.pending = []
+
+    def keys(self):
+        keys = list(self.landing_keys)
+        keys += [key for key in self.query_log.most_common(self.top_n + len(keys)) if key not in keys][:self.top_n]
+        return keys
+
+    def warm(self, keys):
+        """Store the results of the searches, and return the keys of the ones that failed."""
+        failed = []
+        for key in keys:
+            try:
+                self.store.put(key, self.search(key))
+            except Exception as e:
+                print("Warm-up of {} failed: {}".format(key, e))
+                failed.append(key)
+        return failed
+
+    def tick(self):
+        version = self.index_version()
+        if version != self.version:
+            # Stale results must not be served while the new ones are computed.
+            self.store.clear()
+            self.version = version
+            self.refreshed_at = None
+        if self.refreshed_at is None or time.time() - self.refreshed_at >= self.refresh_interval:
+            keys = self.keys()
+            self.store.retain(keys)
+            self.pending = keys
+            self.refreshed_at = time.time()
+        if self.pending:
+            self.pending = self.warm(self.pending)
+            if not any(key in self.pending for key in self.landing_keys):
+                self.store.mark_warmed(version)
+            print("Warm-up for index version {} ({} searches to retry): {}".format(version, len(self.pending), self.store.stats()))
+
+    def run(self):
+        while True:
+            try:
+                self.query_log.save()
+            except Exception as e:
+                print("Saving of the query log failed: {}".format(e))
+            try:
+                self.tick()
+            except Exception as e:
+                print("Warm-up failed: {}".format(e))
+            time.sleep(self.check_interval)